@@ -1,80 +1,248 @@
-import glob
+import functools
+import json
 import os
+import shutil
+import tempfile
+import time
 import zipfile
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
-from io import BytesIO
+from typing import Optional
 from xml.etree import ElementTree
 
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
+# Upper bound on concurrent downloads, also used as the size of the connection pool
+MAX_CONNECTIONS = 32
+
+# Shared session so the TLS connection to Binance is kept alive between downloads
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=MAX_CONNECTIONS,
+        pool_maxsize=MAX_CONNECTIONS,
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]
+        ),
+    ),
+)
+
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+LISTING_URL = "https://s3-ap-northeast-1.amazonaws.com/data.binance.vision?delimiter=/&prefix=data/futures/{market}/daily/liquidationSnapshot/{symbol}/"
+
+# The bucket listing changes at most once a day, so reuse it for an hour
+LISTING_CACHE = "./data/.listing_cache_{symbol}_{market}.json"
+LISTING_CACHE_TTL = 3600
+
+# Within a single process the listing is kept in memory for 5 minutes
+LISTING_MEMORY_TTL = 300
+
+# Columns used by the summary and their types, the rest is not stored as Parquet
+PARQUET_COLUMNS = {
+    "time": pa.int64(),
+    "side": pa.dictionary(pa.int32(), pa.string()),
+    "original_quantity": pa.float64(),
+    "average_price": pa.float64(),
+}
+
+
+def get_existing_files(symbol: str = "BTCUSDT", market: str = "um") -> list[str]:
+    return list(_cached_listing(symbol, market, int(time.time() // LISTING_MEMORY_TTL)))
 
-def get_existing_files() -> list[str]:
-    response = requests.get(
-        "https://s3-ap-northeast-1.amazonaws.com/data.binance.vision?delimiter=/&prefix=data/futures/um/daily/liquidationSnapshot/BTCUSDT/"
-    )
-    tree = ElementTree.fromstring(response.content)
+
+@functools.lru_cache(maxsize=8)
+def _cached_listing(symbol: str, market: str, bucket_epoch: int) -> tuple[str, ...]:
+    # bucket_epoch only changes every LISTING_MEMORY_TTL seconds and expires the cache
+    cache_file = LISTING_CACHE.format(symbol=symbol, market=market)
+
+    # Use the cached listing if it is recent enough
+    if (
+        os.path.exists(cache_file)
+        and time.time() - os.path.getmtime(cache_file) < LISTING_CACHE_TTL
+    ):
+        try:
+            with open(cache_file) as f:
+                return tuple(json.load(f))
+        except ValueError:
+            # A corrupt cache is treated as a miss and overwritten below
+            pass
 
     files = []
-    for content in tree.findall("{http://s3.amazonaws.com/doc/2006-03-01/}Contents"):
-        key = content.find("{http://s3.amazonaws.com/doc/2006-03-01/}Key").text
-        if key.endswith(".zip"):
-            files.append(key)
+    listing_url = LISTING_URL.format(symbol=symbol, market=market)
+    url = listing_url
+    while True:
+        key = None
+        is_truncated = False
+        next_marker = None
+
+        with _SESSION.get(url, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            # Parse the XML while it is received and discard every parsed entry
+            for _, elem in ElementTree.iterparse(response.raw, events=("end",)):
+                if elem.tag == f"{S3_NAMESPACE}Contents":
+                    key = elem.findtext(f"{S3_NAMESPACE}Key")
+                    if key.endswith(".zip"):
+                        files.append(key)
+                    elem.clear()
+                elif elem.tag == f"{S3_NAMESPACE}IsTruncated":
+                    is_truncated = elem.text == "true"
+                elif elem.tag == f"{S3_NAMESPACE}NextMarker":
+                    next_marker = elem.text
 
-    return files
+        # S3 returns at most 1000 keys per request
+        if not is_truncated or key is None:
+            break
+        url = f"{listing_url}&marker={next_marker or key}"
+
+    # Write to a temporary file first, so readers never see a partially written cache
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(cache_file), suffix=".tmp", delete=False
+    ) as f:
+        json.dump(files, f)
+    os.replace(f.name, cache_file)
+
+    return tuple(files)
 
 
 def extract_date_from_filename(filename: str) -> str:
-    return filename.split("liquidationSnapshot-")[-1].split(".")[0]
+    return filename.rpartition("liquidationSnapshot-")[2].partition(".")[0]
 
 
 def get_local_dates(base_path: str, symbol: str, market: str):
-    path_pattern = os.path.join(base_path, symbol, market, "*.csv")
-    local_files = glob.glob(path_pattern)
-    local_dates = {
-        extract_date_from_filename(os.path.basename(file)) for file in local_files
-    }
+    path = os.path.join(base_path, symbol, market)
+    if not os.path.isdir(path):
+        return set()
+
+    with os.scandir(path) as entries:
+        local_dates = {
+            extract_date_from_filename(entry.name)
+            for entry in entries
+            if entry.name.endswith(".csv")
+        }
     return local_dates
 
 
+def get_parquet_dir(symbol: str, market: str = "cm", base_extract_to="./data") -> str:
+    return os.path.join(base_extract_to, "parquet", symbol, market)
+
+
+def get_parquet_partition(
+    symbol: str, date_str: str, market: str = "cm", base_extract_to="./data"
+) -> str:
+    return os.path.join(
+        get_parquet_dir(symbol, market, base_extract_to), f"date={date_str}"
+    )
+
+
+def get_parquet_dates(base_path: str, symbol: str, market: str):
+    # A partition directory only exists once its Parquet file is complete
+    path = get_parquet_dir(symbol, market, base_path)
+    if not os.path.isdir(path):
+        return set()
+
+    with os.scandir(path) as entries:
+        parquet_dates = {
+            entry.name.partition("=")[2]
+            for entry in entries
+            if entry.name.startswith("date=")
+        }
+    return parquet_dates
+
+
+def convert_to_parquet(
+    symbol: str,
+    date_str: str,
+    market: str = "cm",
+    base_extract_to="./data",
+    use_threads: bool = True,
+):
+    """
+    Converts the extracted CSV of a date to Parquet, stored in a hive partitioned dataset
+    under base_extract_to/parquet/symbol/market/date=YYYY-MM-DD.
+
+    Args:
+    symbol (str): The symbol of the data.
+    date_str (str): The date of the data, formatted as YYYY-MM-DD.
+    market (str): The market type. Defaults to "cm".
+    base_extract_to (str): The base directory of the data. Defaults to "./data".
+    use_threads (bool): Whether pyarrow parses the CSV on multiple threads. Defaults to True.
+
+    Returns:
+    None
+    """
+    csv_file = os.path.join(
+        base_extract_to, symbol, market, f"{symbol}-liquidationSnapshot-{date_str}.csv"
+    )
+    partition = get_parquet_partition(symbol, date_str, market, base_extract_to)
+
+    table = pa_csv.read_csv(
+        csv_file,
+        read_options=pa_csv.ReadOptions(use_threads=use_threads),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=PARQUET_COLUMNS, include_columns=list(PARQUET_COLUMNS)
+        ),
+    )
+
+    # Write into a hidden directory and move it into place, so a partition only
+    # exists once it is complete and failed conversions leave no empty directory
+    os.makedirs(os.path.dirname(partition), exist_ok=True)
+    temp_dir = tempfile.mkdtemp(
+        prefix=f".{os.path.basename(partition)}.", dir=os.path.dirname(partition)
+    )
+    try:
+        pq.write_table(
+            table, os.path.join(temp_dir, "part.parquet"), compression="zstd"
+        )
+        shutil.rmtree(partition, ignore_errors=True)
+        os.replace(temp_dir, partition)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
 def download_and_extract_zip(
-    symbol: str, date: datetime, market: str = "cm", base_extract_to="./data"
+    symbol: str, date_str: str, market: str = "cm", base_extract_to="./data"
 ):
     """
     Downloads a ZIP file from the given URL and extracts its contents to a subdirectory named after the symbol.
 
     Args:
     symbol (str): The symbol to download data for.
-    date (datetime): The date for the data.
+    date_str (str): The date for the data, formatted as YYYY-MM-DD.
     market (str): The market type. Defaults to "cm".
     base_extract_to (str): The base directory to extract the contents to. Defaults to "./data".
 
     Returns:
     None
     """
-    # Ensure the base_extract_to directory exists
-    os.makedirs(base_extract_to, exist_ok=True)
-
-    # Create a subdirectory for the symbol
-    extract_to = os.path.join(base_extract_to, symbol)
-    os.makedirs(extract_to, exist_ok=True)
+    # Subdirectory for the symbol and market, created by extractall if it is missing
+    extract_to = os.path.join(base_extract_to, symbol, market)
 
-    # Subdirectory for the market
-    extract_to = os.path.join(extract_to, market)
-    os.makedirs(extract_to, exist_ok=True)
-
-    date_str = date.strftime("%Y-%m-%d")
     url = f"https://data.binance.vision/data/futures/{market}/daily/liquidationSnapshot/{symbol}/{symbol}-liquidationSnapshot-{date_str}.zip"
 
     try:
-        # Step 1: Download the ZIP file
-        response = requests.get(url)
-        response.raise_for_status()  # Ensure the request was successful
+        # Step 1: Stream the ZIP file into a buffer that spills to disk above 8 MiB
+        with _SESSION.get(url, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status()  # Ensure the request was successful
+            with tempfile.SpooledTemporaryFile(max_size=8 << 20) as buffer:
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, buffer, length=1 << 16)
+                buffer.seek(0)
+
+                # Step 2: Extract the contents of the ZIP file
+                with zipfile.ZipFile(buffer) as zip_ref:
+                    zip_ref.extractall(extract_to)
 
-        # Step 2: Extract the contents of the ZIP file
-        with zipfile.ZipFile(BytesIO(response.content)) as zip_ref:
-            zip_ref.extractall(extract_to)
+        # Step 3: Store the columns used by the summary as Parquet
+        convert_to_parquet(symbol, date_str, market, base_extract_to)
 
         # print(f"Extracted all contents to {extract_to} for date {date_str}")
     except requests.RequestException as e:
@@ -84,20 +252,78 @@ def download_and_extract_zip(
 
 
 def get_new_data(
-    symbol: str, market: str = "cm", base_extract_to: str = "./data"
-) -> set[str]:
-    existing_files = get_existing_files()
+    symbol: str,
+    market: str = "cm",
+    base_extract_to: str = "./data",
+    max_workers: Optional[int] = None,
+) -> tuple[set[str], set[str]]:
+    """
+    Downloads all liquidation snapshots that are available on Binance but not stored locally.
+
+    Args:
+    symbol (str): The symbol to download data for.
+    market (str): The market type. Defaults to "cm".
+    base_extract_to (str): The base directory to extract the contents to. Defaults to "./data".
+    max_workers (int): The number of concurrent downloads, at most 32. Defaults to the
+        LIQ_DOWNLOAD_WORKERS environment variable, or cpu_count + 4 if that is not set.
+
+    Returns:
+    tuple[set[str], set[str]]: The dates that were missing locally and the dates
+        that were already downloaded but only now converted to Parquet.
+    """
+    existing_files = get_existing_files(symbol, market)
     existing_dates = {extract_date_from_filename(file) for file in existing_files}
 
     local_dates = get_local_dates(base_extract_to, symbol, market)
     missing_dates = existing_dates - local_dates
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    # Convert dates that were downloaded before they were stored as Parquet
+    unconverted_dates = local_dates - get_parquet_dates(base_extract_to, symbol, market)
+    converted_dates = set()
+    if unconverted_dates:
+        # Convert one file per thread, each parsed single-threaded by pyarrow so the
+        # pool does not oversubscribe the CPU
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            futures = {
+                executor.submit(
+                    convert_to_parquet, symbol, date, market, base_extract_to, False
+                ): date
+                for date in unconverted_dates
+            }
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="Converting files"
+            ):
+                try:
+                    future.result()
+                    converted_dates.add(futures[future])
+                except Exception as e:
+                    print(f"Failed to convert {futures[future]} to Parquet: {e}")
+
+    workers = max_workers
+    if workers is None:
+        env_workers = os.environ.get("LIQ_DOWNLOAD_WORKERS")
+        if env_workers is None:
+            workers = (os.cpu_count() or 1) + 4
+        else:
+            try:
+                workers = int(env_workers)
+            except ValueError:
+                raise ValueError(
+                    f"LIQ_DOWNLOAD_WORKERS must be an integer, got {env_workers!r}"
+                ) from None
+
+    # Create the directory once, instead of in every download
+    os.makedirs(os.path.join(base_extract_to, symbol, market), exist_ok=True)
+
+    # Don't exceed the connection pool or spawn idle threads for small updates
+    workers = max(1, min(workers, MAX_CONNECTIONS, len(missing_dates)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         futures = [
             executor.submit(
                 download_and_extract_zip,
                 symbol,
-                datetime.strptime(date, "%Y-%m-%d"),
+                date,
                 market,
                 base_extract_to,
             )
@@ -112,4 +338,4 @@ def get_new_data(
                 except Exception as e:
                     print(f"Error occurred: {e}")
 
-    return missing_dates
+    return missing_dates, converted_dates
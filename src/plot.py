@@ -1,5 +1,6 @@
+import os
+from bisect import bisect_right
 from datetime import timedelta
-from math import floor, log
 
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
@@ -7,12 +8,16 @@ import pandas as pd
 from matplotlib import ticker
 
 from data import get_new_data
-from summary import summarize_liquidations
+from summary import get_summary_path, summarize_liquidations
 
 BACKGROUND_COLOR = "#0d1117"
 FIGURE_SIZE = (15, 7)
 COLORS_LABELS = {"#d9024b": "Shorts", "#45bf87": "Longs", "#f0b90b": "Price"}
 
+# https://idlechampions.fandom.com/wiki/Large_number_abbreviations
+UNITS = ("", "K", "M", "B", "t", "q")
+UNIT_CUTOFFS = (1e3, 1e6, 1e9, 1e12, 1e15)
+
 
 def human_format(number: float, absolute: bool = False, decimals: int = 0) -> str:
     """
@@ -44,10 +49,9 @@ def human_format(number: float, absolute: bool = False, decimals: int = 0) -> st
     if number == 0:
         return "0"
 
-    # https://idlechampions.fandom.com/wiki/Large_number_abbreviations
-    units = ["", "K", "M", "B", "t", "q"]
+    # Look up the magnitude instead of computing log(abs(number), 1000)
     k = 1000.0
-    magnitude = int(floor(log(abs(number), k)))
+    magnitude = bisect_right(UNIT_CUTOFFS, abs(number))
 
     if decimals > 0:
         rounded_number = round(number / k**magnitude, decimals)
@@ -57,7 +61,7 @@ def human_format(number: float, absolute: bool = False, decimals: int = 0) -> st
     if absolute:
         rounded_number = abs(rounded_number)
 
-    return f"{rounded_number}{units[magnitude]}"
+    return f"{rounded_number}{UNITS[magnitude]}"
 
 
 def add_legend(ax):
@@ -194,17 +198,18 @@ def liquidations_plot(df):
 
 
 def show_plot(coin="BTCUSDT", market="um"):
-    new_data = get_new_data(coin, market=market)
-    if new_data:
-        print(f"Downloaded {len(new_data)} new files.")
-        # Recreate the summary
-        summarize_liquidations(coin=coin, market=market)
-    # Load the summary
-    df = pd.read_csv(
-        f"data/summary/{coin}/{market}/liquidation_summary.csv",
-        index_col=0,
-        parse_dates=True,
-    )
+    summary_file = get_summary_path(coin, market)
+    downloaded, converted = get_new_data(coin, market=market)
+    if downloaded:
+        print(f"Downloaded {len(downloaded)} new files.")
+    if converted:
+        print(f"Converted {len(converted)} existing files to Parquet.")
+    new_data = downloaded | converted
+    if new_data or not os.path.exists(summary_file):
+        # Add the new dates to the summary, or create it if it does not exist yet
+        summarize_liquidations(coin=coin, market=market, only_dates=new_data)
+    # Load the summary, it only has one row per day
+    df = pd.read_parquet(summary_file)
 
     # Use the last 6 months
-    liquidations_plot(df[-180:])
+    liquidations_plot(df.iloc[-180:])
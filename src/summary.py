@@ -1,91 +1,89 @@
-import glob
 import os
-from datetime import datetime
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 
+from data import PARQUET_COLUMNS, get_parquet_dir
 
-def convert_timestamp_to_date(timestamp):
-    return datetime.utcfromtimestamp(timestamp / 1000).strftime("%Y-%m-%d")
 
+def get_summary_path(coin="BTCUSDT", market="um") -> str:
+    return f"data/summary/{coin}/{market}/liquidation_summary.parquet"
 
-def summarize_liquidations(coin="BTCUSDT", market="um"):
-    file_pattern = f"data/{coin}/{market}/*.csv"
-    # Read all CSV files matching the pattern
-    all_files = glob.glob(file_pattern)
 
-    df_list = []
-    for file in all_files:
-        df = pd.read_csv(file)
-        df_list.append(df)
+def summarize_liquidations(coin="BTCUSDT", market="um", only_dates=None):
+    summary_file = get_summary_path(coin, market)
+    parquet_dir = get_parquet_dir(coin, market)
+    if not os.path.isdir(parquet_dir):
+        return
 
-    # Concatenate all DataFrames into a single DataFrame
-    all_data = pd.concat(df_list, ignore_index=True)
+    # Only summarize the new dates if there is a previous summary to add them to
+    incremental = only_dates is not None and os.path.exists(summary_file)
 
-    # Remove duplicate rows
-    all_data.drop_duplicates(inplace=True)
-
-    # Convert the 'time' column to date
-    all_data["date"] = all_data["time"].apply(convert_timestamp_to_date)
-
-    # Calculate total volume in USD
-    all_data["volume"] = all_data["original_quantity"] * all_data["average_price"]
-
-    # Summarize the data
-    summary = (
-        all_data.groupby(["date", "side"])
-        .agg(
-            total_volume=("volume", "sum"),
-            total_liquidations=("original_quantity", "sum"),  # used for avg price
-        )
-        .reset_index()
+    # Read the columns used from the Parquet dataset, one partition per date
+    dataset = ds.dataset(
+        parquet_dir,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
     )
+    if not dataset.files:
+        return
 
-    summary["average_price"] = summary["total_volume"] / summary["total_liquidations"]
-
-    # Pivot the summary to have separate columns for buy and sell sides
-    pivot_summary = summary.pivot(
-        index="date", columns="side", values=["total_volume", "average_price"]
-    ).fillna(0)
-    pivot_summary.columns = [
-        "_".join(col).strip() for col in pivot_summary.columns.values
-    ]
-    pivot_summary = pivot_summary.rename(
-        columns={
-            "total_volume_BUY": "Buy Volume (USD)",
-            "total_volume_SELL": "Sell Volume (USD)",
-            "average_price_BUY": "Average Buy Price",
-            "average_price_SELL": "Average Sell Price",
-        }
+    table = dataset.to_table(
+        columns=list(PARQUET_COLUMNS),
+        filter=ds.field("date").isin(list(only_dates)) if incremental else None,
     )
+    if table.num_rows == 0:
+        return
 
-    # Calculate overall average price
-    pivot_summary["Average Price"] = (
-        pivot_summary["Average Buy Price"] * pivot_summary["Buy Volume (USD)"]
-        + pivot_summary["Average Sell Price"] * pivot_summary["Sell Volume (USD)"]
-    ) / (pivot_summary["Buy Volume (USD)"] + pivot_summary["Sell Volume (USD)"])
+    # No deduplication needed, Binance publishes exactly one file per UTC day
+    # side is dictionary encoded in Parquet, so it is already read as a category
+    all_data = table.to_pandas()
 
-    # Drop individual average price columns if only overall average price is needed
-    pivot_summary.drop(
-        columns=["Average Buy Price", "Average Sell Price"], inplace=True
+    # Convert the 'time' column to date
+    all_data["date"] = pd.to_datetime(all_data["time"], unit="ms").dt.floor("D")
+
+    # Calculate total volume in USD
+    all_data["volume"] = (
+        all_data["original_quantity"].to_numpy() * all_data["average_price"].to_numpy()
     )
 
-    # Rename columns as required
-    pivot_summary.rename(
-        columns={
-            "Buy Volume (USD)": "Shorts",
-            "Sell Volume (USD)": "Longs",
-            "Average Price": "price",
-        },
-        inplace=True,
+    # Summarize each side directly into its own columns, buy liquidations are shorts
+    buy = (
+        all_data[all_data["side"] == "BUY"]
+        .groupby("date", sort=False)
+        .agg(Shorts=("volume", "sum"), buy_quantity=("original_quantity", "sum"))
     )
+    sell = (
+        all_data[all_data["side"] == "SELL"]
+        .groupby("date", sort=False)
+        .agg(Longs=("volume", "sum"), sell_quantity=("original_quantity", "sum"))
+    )
+    pivot_summary = buy.join(sell, how="outer").fillna(0).sort_index()
 
-    # Convert the index to datetime and set it as index
-    pivot_summary["date"] = pd.to_datetime(pivot_summary.index)
-    pivot_summary = pivot_summary.set_index("date")
+    # Calculate overall average price, weighted by the volume of each side
+    average_buy_price = (
+        pivot_summary["Shorts"] / pivot_summary["buy_quantity"]
+    ).fillna(0)
+    average_sell_price = (
+        pivot_summary["Longs"] / pivot_summary["sell_quantity"]
+    ).fillna(0)
+    pivot_summary["price"] = (
+        average_buy_price * pivot_summary["Shorts"]
+        + average_sell_price * pivot_summary["Longs"]
+    ) / (pivot_summary["Shorts"] + pivot_summary["Longs"])
+    pivot_summary = pivot_summary[["Shorts", "Longs", "price"]]
+
+    if incremental:
+        # Replace the summarized dates in the previous summary
+        old_summary = pd.read_parquet(summary_file)
+        pivot_summary = pd.concat(
+            [
+                old_summary.drop(index=pivot_summary.index, errors="ignore"),
+                pivot_summary,
+            ]
+        ).sort_index()
 
     # Save it locally
-    os.makedirs("data/summary", exist_ok=True)
-    os.makedirs(f"data/summary/{coin}", exist_ok=True)
-    os.makedirs(f"data/summary/{coin}/{market}", exist_ok=True)
-    pivot_summary.to_csv(f"data/summary/{coin}/{market}/liquidation_summary.csv")
+    os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    pivot_summary.to_parquet(summary_file)